@@ -1,19 +1,76 @@
+import asyncio
+import hashlib
 import logging
 import os
 import re
+import shutil
 import subprocess
+import tarfile
+import tempfile
 import time
-import winreg
 from argparse import ArgumentParser
+from collections import deque
 from datetime import datetime
-from multiprocessing import Lock, pool
 from pathlib import Path
 
 import httpx
+import orjson
 import vdf
 from colorama import Fore
 from colorlog import ColoredFormatter
-from retrying import retry
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+CACHE_DIR = Path.home() / '.cache' / 'manifest'
+ETAG_CACHE = CACHE_DIR / 'etags.json'
+BLOB_CACHE = CACHE_DIR / 'blobs'
+BLOB_CACHE_MAX = 256
+TARBALL_MIN_FILES = 8
+TARBALL_MIN_RATIO = 0.5
+RATE_LIMIT_MAX_WAIT = 60
+HEAD_FIELDS = ('ref(qualifiedName: $branch) { target { ... on Commit { oid '
+               'committedDate tree { entries { name oid type object { ... on Blob { byteSize } } } } } } }')
+DEPOT_KEY_RE = re.compile(rb'"(\d+)"\s*\{[^{}]*?"DecryptionKey"\s*"([0-9a-fA-F]+)"')
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f'请求受限, 需等待{retry_after:.0f}秒')
+        self.retry_after = retry_after
+
+
+def raise_for_retry(result: httpx.Response, spare_token=False):
+    if result.status_code >= 500:
+        result.raise_for_status()
+    if result.status_code not in (403, 429):
+        return
+    retry_after = result.headers.get('Retry-After')
+    if retry_after:
+        raise RateLimitError(float(retry_after))
+    if result.headers.get('X-RateLimit-Remaining') == '0':
+        reset = int(result.headers.get('X-RateLimit-Reset', 0))
+        raise RateLimitError(0 if spare_token else max(reset - time.time(), 0))
+
+
+def is_retryable(exception: BaseException):
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code >= 500
+    if isinstance(exception, RateLimitError):
+        return exception.retry_after <= RATE_LIMIT_MAX_WAIT
+    return isinstance(exception, httpx.TransportError)
+
+
+def wait_retry_after(retry_state: RetryCallState):
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, RateLimitError):
+        return exception.retry_after
+    return wait_exponential_jitter(initial=0.5, max=10)(retry_state)
+
+
+retry_request = retry(
+    wait=wait_retry_after,
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable),
+    reraise=True)
 
 
 def show_banner():
@@ -32,19 +89,58 @@ def init_args():
     parser = ArgumentParser()
     parser.add_argument('-v', '--version', action='version', version=f'%(prog)s v{version}')
     parser.add_argument('-a', '--appid', help='steam appid')
-    parser.add_argument('-k', '--key', help='github API key')
+    parser.add_argument('-k', '--key', help='github API key, comma separated for multiple keys')
     parser.add_argument('-r', '--repo', help='github repo name')
     parser.add_argument('-f', '--fixed', action='store_true', help='fixed manifest')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='concurrent downloads')
     parser.add_argument('-d', '--debug', action='store_true', help='debug mode')
     return parser.parse_args()
 
 
-def remove_duplicates(tuples: list[tuple[int, str | None]]):
-    result_dict = {}
-    for t in tuples:
-        if t[0] not in result_dict or (result_dict[t[0]][1] is None and t[1] is not None):
-            result_dict[t[0]] = t
-    return list(result_dict.values())
+def pkt_line(data: str):
+    payload = data.encode()
+    return f'{len(payload) + 4:04x}'.encode() + payload
+
+
+def parse_pkt_lines(data: bytes):
+    i = 0
+    lines = []
+    while i + 4 <= len(data):
+        length = int(data[i:i + 4], 16)
+        if length < 4:
+            i += 4
+            continue
+        lines.append(data[i + 4:i + length].decode().rstrip('\n'))
+        i += length
+    return lines
+
+
+def split_manifest(name: str):
+    i = name.index('_')
+    return int(name[:i]), name[i + 1:name.rindex('.')]
+
+
+def leaf_exceptions(error: BaseException):
+    if isinstance(error, BaseExceptionGroup):
+        return [leaf for sub_error in error.exceptions for leaf in leaf_exceptions(sub_error)]
+    return [error]
+
+
+def extract_tarball(tar_path: Path, names: set[str]):
+    extracted = set()
+    with tarfile.open(tar_path, 'r:gz') as tar:
+        for member in tar:
+            name = member.name.partition('/')[2]
+            if member.isfile() and name in names:
+                with tar.extractfile(member) as src, (tar_path.parent / name).open('wb') as dst:
+                    shutil.copyfileobj(src, dst, 64 * 1024)
+                extracted.add(name)
+    return extracted
+
+
+def git_blob_sha(path: Path):
+    content = path.read_bytes()
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
 
 
 class MainApp:
@@ -53,7 +149,22 @@ class MainApp:
         self.logr = self.init_logger()
         self.manifests: list[str] = []
         self.depots: list[tuple[int, str | None]] = []
-        self.lock = Lock()
+        self.client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            headers={'User-Agent': f'ciocoa-manifest/{version}'})
+        self.sem = asyncio.Semaphore(max(self.args.workers, 1))
+        self.etags: dict[str, dict] = self.load_cache(ETAG_CACHE)
+        self.index: dict[str, str] = {}
+        self.heads: dict[tuple[str, str], dict] = {}
+        self.existing: set[str] = set()
+        keys = os.getenv('GITHUB_API_TOKEN') or self.args.key or ''
+        self.tokens = deque(key.strip() for key in keys.split(',') if key.strip())
+        self.cooldown: dict[str, int] = {}
+        self.api_headers = {'Accept': 'application/vnd.github+json'}
+        self.token_headers = {token: self.api_headers | {'Authorization': f'Bearer {token}'} for token in self.tokens}
         self.appinfo = self.get_appinfo()
 
     def init_logger(self):
@@ -82,39 +193,80 @@ class MainApp:
         except KeyboardInterrupt:
             exit()
 
-    def run(self):
-        steam_path = self.check_steam_path()
+    def load_cache(self, path: Path):
+        try:
+            return orjson.loads(path.read_bytes())
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, path: Path, data: dict):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(orjson.dumps(data))
+        except OSError as e:
+            self.logr.debug(f'缓存写入失败: {e}')
+
+    async def run(self):
+        try:
+            await self.process()
+        finally:
+            await self.client.aclose()
+            self.save_cache(ETAG_CACHE, self.etags)
+
+    async def process(self):
+        (steam_path, lua_path), (limit_error, curr_repo) = await asyncio.gather(
+            asyncio.to_thread(self.check_paths), self.check_remote())
         if not steam_path:
             self.logr.error(f'Steam路径不存在')
             return
-        lua_path = self.check_lua_path(steam_path)
         if not lua_path:
             self.logr.error(f'Luapacka路径不存在')
             return
-        reset_time = self.check_api_limit()
-        if reset_time:
-            self.logr.error(f'请求次数已用尽, 重置时间: {reset_time}')
+        if limit_error:
+            self.logr.error(limit_error)
             return
-        curr_repo = self.check_curr_repo()
         if not curr_repo:
             self.logr.error(f'仓库暂无数据, 入库失败: {self.appinfo[0]}')
             return
+        depot_cache = steam_path / 'config' / 'depotcache'
+        depot_cache.mkdir(parents=True, exist_ok=True)
+        self.existing = {entry.name for entry in os.scandir(depot_cache)}
+        index_path = depot_cache / '.index.json'
+        self.index = self.load_cache(index_path)
         try:
-            self.start(curr_repo, self.appinfo[0], steam_path)
-        except KeyboardInterrupt:
-            exit()
+            await self.start(curr_repo, self.appinfo[0], steam_path)
         except Exception as e:
-            self.logr.error(f'异常错误: {e}')
+            for error in leaf_exceptions(e):
+                self.logr.error(f'异常错误: {error!r}')
+        finally:
+            self.save_cache(index_path, self.index)
+            self.save_cache(ETAG_CACHE, self.etags)
         if not self.args.appid:
             self.logr.critical('运行结束')
-            time.sleep(0.1)
             subprocess.call('pause', shell=True)
 
+    def check_paths(self):
+        steam_path = self.check_steam_path()
+        lua_path = self.check_lua_path(steam_path) if steam_path else None
+        return steam_path, lua_path
+
+    async def check_remote(self):
+        try:
+            limit_error = await self.check_api_limit()
+            if limit_error:
+                return limit_error, None
+            return None, await self.check_curr_repo()
+        except RateLimitError as e:
+            return str(e), None
+        except httpx.HTTPError as e:
+            return f'网络请求失败: {e!r}', None
+
     def check_steam_path(self):
+        import winreg
         try:
-            hkey = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Valve\Steam')
-            steam_path = Path(winreg.QueryValueEx(hkey, 'SteamPath')[0])
-            if 'steam.exe' in os.listdir(steam_path):
+            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Valve\Steam') as hkey:
+                steam_path = Path(winreg.QueryValueEx(hkey, 'SteamPath')[0])
+            if (steam_path / 'steam.exe').is_file():
                 self.logr.info(f'检测到Steam: {steam_path}')
                 return steam_path
         except Exception as e:
@@ -123,156 +275,375 @@ class MainApp:
     def check_lua_path(self, path: Path):
         try:
             lua_path = path / 'config' / 'stplug-in'
-            if 'luapacka.exe' in os.listdir(lua_path):
+            if (lua_path / 'luapacka.exe').is_file():
                 self.logr.info(f'检测到Luapacka: {lua_path}')
                 return lua_path
         except Exception as e:
             self.logr.error(e)
 
-    def check_api_limit(self):
-        limit_res = self.api_request('https://api.github.com/rate_limit')
-        reset = limit_res['rate']['reset']
-        remaining = limit_res['rate']['remaining']
+    async def check_api_limit(self):
+        limit_url = 'https://api.github.com/rate_limit'
+        limit_list = await asyncio.gather(
+            *(self.api_request(limit_url, cached=True) for _ in range(max(len(self.tokens), 1))))
+        rate_list = [limit_res['rate'] for limit_res in limit_list if limit_res and 'rate' in limit_res]
+        if not rate_list:
+            return '请求次数查询失败'
+        reset = min(rate['reset'] for rate in rate_list)
+        remaining = sum(rate['remaining'] for rate in rate_list)
         self.logr.info(f'剩余请求次数: {remaining}')
         reset_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reset))
         if remaining == 0:
-            return reset_time
+            return f'请求次数已用尽, 重置时间: {reset_time}'
 
-    def check_curr_repo(self):
-        last_date = None
-        curr_repo = None
+    async def check_curr_repo(self):
         repos = self.get_repos()
-        for repo in repos:
-            branch_res = self.api_request(f'https://api.github.com/repos/{repo}/branches/{self.appinfo[0]}')
-            if branch_res and 'commit' in branch_res:
-                date = branch_res['commit']['commit']['committer']['date']
-                if last_date is None or date > last_date:
-                    last_date = date
-                    curr_repo = repo
+        heads = await self.query_heads(repos, self.appinfo[0]) if self.tokens else None
+        if heads is not None:
+            curr_repo = self.find_repo_by_heads(heads, self.appinfo[0])
+        elif len(repos) == 1:
+            curr_repo = await self.find_repo_by_rest(repos[0], self.appinfo[0])
+        else:
+            curr_repo = await self.find_repo_by_git(repos, self.appinfo[0])
         self.logr.info(f'当前清单仓库: {curr_repo}')
         return curr_repo
 
-    def start(self, repo: str, branch: str, path: Path, is_dlc=False):
-        branch_res = self.api_request(f'https://api.github.com/repos/{repo}/branches/{branch}')
+    def find_repo_by_heads(self, heads: dict[str, dict], branch: str):
+        self.heads.update(((repo, branch), head) for repo, head in heads.items())
+        return max(heads, key=lambda repo: heads[repo]['date'], default=None)
+
+    async def find_repo_by_rest(self, repo: str, branch: str):
+        head = await self.fetch_rest_head(repo, branch)
+        if head:
+            self.heads[(repo, branch)] = head
+            return repo
+
+    async def find_repo_by_git(self, repos: list[str], branch: str):
+        last_date = None
+        curr_repo = None
+        sha_list = await asyncio.gather(*(self.ls_remote(repo, branch) for repo in repos))
+        heads = {repo: sha for repo, sha in zip(repos, sha_list) if sha}
+        if len(set(heads.values())) == 1:
+            curr_repo = next(iter(heads))
+        elif heads:
+            commit_urls = (f'https://api.github.com/repos/{repo}/commits/{sha}' for repo, sha in heads.items())
+            commit_list = await asyncio.gather(*(self.api_request(url) for url in commit_urls))
+            for repo, commit_res in zip(heads, commit_list):
+                if commit_res and 'commit' in commit_res:
+                    date = commit_res['commit']['committer']['date']
+                    if last_date is None or date > last_date:
+                        last_date = date
+                        curr_repo = repo
+        return curr_repo
+
+    async def query_heads(self, repos: list[str], branch: str):
+        params = ['$branch: String!']
+        fields = []
+        variables = {'branch': f'refs/heads/{branch}'}
+        for i, repo in enumerate(repos):
+            owner, _, name = repo.partition('/')
+            params += [f'$owner{i}: String!', f'$name{i}: String!']
+            fields.append(f'repo{i}: repository(owner: $owner{i}, name: $name{i}) {{ {HEAD_FIELDS} }}')
+            variables |= {f'owner{i}': owner, f'name{i}': name}
+        data = await self.graphql(f'query({", ".join(params)}) {{ {" ".join(fields)} }}', variables)
+        if data is None:
+            return
+        heads = {}
+        for i, repo in enumerate(repos):
+            ref = (data.get(f'repo{i}') or {}).get('ref')
+            if ref and ref['target']:
+                commit: dict = ref['target']
+                tree_list = [{'path': e['name'], 'sha': e['oid'], 'type': e['type'],
+                              'size': (e['object'] or {}).get('byteSize', 0)} for e in commit['tree']['entries']]
+                heads[repo] = {'oid': commit['oid'], 'date': commit['committedDate'], 'tree': tree_list}
+        return heads
+
+    async def fetch_head(self, repo: str, branch: str):
+        if self.tokens:
+            heads = await self.query_heads([repo], branch)
+            if heads is not None:
+                return heads.get(repo)
+        return await self.fetch_rest_head(repo, branch)
+
+    async def fetch_rest_head(self, repo: str, branch: str):
+        branch_res = await self.api_request(f'https://api.github.com/repos/{repo}/branches/{branch}', cached=True)
         if not branch_res or 'commit' not in branch_res:
             return
-        tree_url = branch_res['commit']['commit']['tree']['url']
-        commit_date = branch_res['commit']['commit']['committer']['date']
-        tree_res = self.api_request(tree_url)
+        commit: dict = branch_res['commit']['commit']
+        tree_res = await self.api_request(commit['tree']['url'])
         if not tree_res or 'tree' not in tree_res:
             return
+        return {'oid': branch_res['commit']['sha'], 'date': commit['committer']['date'], 'tree': tree_res['tree']}
+
+    async def start(self, repo: str, branch: str, path: Path, is_dlc=False):
+        head = self.heads.pop((repo, branch), None) or await self.fetch_head(repo, str(branch))
+        if not head:
+            return
+        commit_date = head['date']
         self.depots.append((int(branch), None))
-        with pool.ThreadPool() as tpool:
-            tasks = [tpool.apply_async(self.manifest, (repo, branch, tree['path'], path)) for tree in tree_res['tree']]
-            try:
-                for task in tasks:
-                    task.get()
-            except KeyboardInterrupt:
-                with self.lock:
-                    tpool.terminate()
-                raise
-        if all(task.successful() for task in tasks) and not is_dlc:
-            self.set_appinfo(path)
+        depot_cache = path / 'config' / 'depotcache'
+        tree_list: list[dict] = head['tree']
+        pending = await asyncio.to_thread(self.pending_manifests, depot_cache, tree_list)
+        pending_size = sum(tree.get('size', 0) for tree in pending)
+        total_size = sum(tree.get('size', 0) for tree in tree_list)
+        if len(pending) >= TARBALL_MIN_FILES and pending_size >= total_size * TARBALL_MIN_RATIO:
+            await self.tarball(repo, head['oid'], tree_list, pending, path)
+        else:
+            async with asyncio.TaskGroup() as tg:
+                for tree in tree_list:
+                    tg.create_task(self.manifest(repo, head['oid'], tree, path))
+        if not is_dlc:
+            await self.set_appinfo(path)
             self.logr.info(f'清单最后更新时间: {commit_date}')
             self.logr.info(f'入库成功: {self.appinfo}')
 
-    def manifest(self, repo: str, branch: str, path: str, steam_path: Path):
+    async def tarball(self, repo: str, ref: str, tree_list: list[dict], pending: list[dict], steam_path: Path):
+        names = {tree['path'] for tree in pending}
+        names.update(tree['path'] for tree in tree_list if not tree['path'].endswith('.manifest'))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tar_path = Path(tmp_dir) / f'{ref}.tar.gz'
+            await self.download_to(f'https://api.github.com/repos/{repo}/tarball/{ref}', tar_path, api=True)
+            extracted = await asyncio.to_thread(extract_tarball, tar_path, names)
+            async with asyncio.TaskGroup() as tg:
+                for tree in tree_list:
+                    source = tar_path.parent / tree['path'] if tree['path'] in extracted else None
+                    tg.create_task(self.manifest(repo, ref, tree, steam_path, source))
+
+    async def manifest(self, repo: str, ref: str, tree: dict, steam_path: Path, source: Path | None = None):
+        path: str = tree['path']
         try:
-            url = f'https://raw.githubusercontent.com/{repo}/{branch}/{path}'
+            url = f'https://raw.githubusercontent.com/{repo}/{ref}/{path}'
             if path.endswith('.manifest'):
                 self.manifests.append(path)
-                depot_cache = steam_path / 'config' / 'depotcache'
-                with self.lock:
-                    if not depot_cache.exists():
-                        depot_cache.mkdir(parents=True, exist_ok=True)
-                save_path = depot_cache / path
-                if save_path.exists():
-                    with self.lock:
-                        self.logr.warning(f'清单已存在: {path}')
+                save_path = steam_path / 'config' / 'depotcache' / path
+                if self.is_cached(save_path, tree['sha']):
+                    self.logr.warning(f'清单已存在: {path}')
                     return
-                manifest_res = self.raw_content(url)
-                with self.lock:
-                    self.logr.info(f'清单已下载: {path}')
-                with save_path.open('wb') as f:
-                    f.write(manifest_res)
+                if source is None:
+                    await self.download_to(url, save_path)
+                else:
+                    await asyncio.to_thread(shutil.move, source, save_path)
+                self.index[save_path.name] = tree['sha']
+                self.existing.add(save_path.name)
+                self.logr.info(f'清单已下载: {path}')
             if path.endswith('.vdf') and path in ['appinfo.vdf']:
-                info_res = self.raw_content(url)
+                info_res = await self.blob_content(url, tree['sha'], source)
                 appinfo_config = vdf.loads(info_res.decode())
                 appinfo_dict: dict[str, str] = appinfo_config['common']
                 appname = re.sub(r'\W+', ' ', appinfo_dict['name'])
                 self.appinfo.append(appname)
             if path.endswith('.vdf') and path in ['config.vdf']:
-                key_res = self.raw_content(url)
-                depot_config = vdf.loads(key_res.decode())
-                depot_dict: dict = depot_config['depots']
-                self.depots.extend((int(k), v['DecryptionKey']) for k, v in depot_dict.items())
-                with self.lock:
-                    self.logr.info(f'检测到密钥信息 {depot_dict}...')
+                key_res = await self.blob_content(url, tree['sha'], source)
+                depot_keys = [(int(k), v.decode()) for k, v in DEPOT_KEY_RE.findall(key_res)]
+                if not depot_keys:
+                    depot_config = vdf.loads(key_res.decode())
+                    depot_dict: dict = depot_config['depots']
+                    depot_keys = [(int(k), v['DecryptionKey']) for k, v in depot_dict.items()]
+                self.depots.extend(depot_keys)
+                self.logr.info(f'检测到密钥信息 {dict(depot_keys)}...')
             if path.endswith('.json') and path in ['config.json']:
-                config_res = self.api_request(url)
+                config_res = orjson.loads(await self.blob_content(url, tree['sha'], source))
                 dlcs: list[int | str] = config_res['dlcs']
                 ddlc: list[int | str] = config_res['packagedlcs']
                 if dlcs and len(dlcs) > 0:
-                    with self.lock:
-                        self.logr.info(f'检测到DLC信息 {dlcs}...')
+                    self.logr.info(f'检测到DLC信息 {dlcs}...')
                     self.depots.extend((k, None) for k in dlcs)
                 if ddlc and len(ddlc) > 0:
-                    with self.lock:
-                        self.logr.info(f'检测到独立DLC {ddlc}...')
-                    [self.start(repo, dlc, steam_path, True) for dlc in ddlc]
+                    self.logr.info(f'检测到独立DLC {ddlc}...')
+                    async with asyncio.TaskGroup() as tg:
+                        for dlc in ddlc:
+                            tg.create_task(self.start(repo, dlc, steam_path, True))
         except Exception as e:
             self.logr.error(f'出现异常: {e}')
             raise
 
-    def set_appinfo(self, path: Path):
-        depot_list = sorted(set(self.depots), key=lambda x: x[0])
-        depot_list = remove_duplicates(depot_list)
-        lua_content = f'-- {self.appinfo[1]}\n'
-        lua_content += ''.join(
-            f'addappid({depot_id}, 1, "{depot_key}")\n' if depot_key else f'addappid({depot_id}, 1)\n' for
+    async def blob_content(self, url: str, sha: str, source: Path | None = None):
+        blob_path = BLOB_CACHE / sha
+        if source is None and blob_path.is_file():
+            self.logr.debug(f'缓存内容: {url}')
+            return await asyncio.to_thread(self.load_blob, blob_path)
+        if source is None:
+            content = await self.raw_content(url)
+        else:
+            content = await asyncio.to_thread(source.read_bytes)
+        if content is not None:
+            await asyncio.to_thread(self.save_blob, blob_path, content)
+        return content
+
+    def load_blob(self, path: Path):
+        path.touch()
+        return path.read_bytes()
+
+    def save_blob(self, path: Path, content: bytes):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+            entries = sorted(os.scandir(path.parent), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:-BLOB_CACHE_MAX]:
+                os.remove(entry.path)
+        except OSError as e:
+            self.logr.debug(f'缓存写入失败: {e}')
+
+    def pending_manifests(self, depot_cache: Path, tree_list: list[dict]):
+        return [tree for tree in tree_list if
+                tree['path'].endswith('.manifest') and not self.is_cached(depot_cache / tree['path'], tree['sha'])]
+
+    def is_cached(self, path: Path, sha: str):
+        if path.name not in self.existing:
+            return False
+        if path.name not in self.index:
+            self.index[path.name] = git_blob_sha(path)
+        return self.index[path.name] == sha
+
+    async def set_appinfo(self, path: Path):
+        depot_dict: dict[int, str | None] = {}
+        for depot_id, depot_key in self.depots:
+            if depot_key or int(depot_id) not in depot_dict:
+                depot_dict[int(depot_id)] = depot_key
+        depot_list = sorted(depot_dict.items())
+        lua_lines = [f'-- {self.appinfo[1]}']
+        lua_lines.extend(
+            f'addappid({depot_id}, 1, "{depot_key}")' if depot_key else f'addappid({depot_id}, 1)' for
             depot_id, depot_key in depot_list)
         if self.args.fixed:
-            manifest_list = sorted(
-                [(split_x[0], split_x[1].split('.')[0]) for split_x in (x.split('_') for x in self.manifests)],
-                key=lambda x: x[0])
-            lua_content += ''.join(
-                f'setManifestid({depot_id}, "{manifest_id}")\n' for depot_id, manifest_id in manifest_list)
+            manifest_list = sorted(map(split_manifest, self.manifests))
+            lua_lines.extend(
+                f'setManifestid({depot_id}, "{manifest_id}")' for depot_id, manifest_id in manifest_list)
+        lua_content = '\n'.join(lua_lines) + '\n'
         lua_filename = f'{self.appinfo[0]} - {self.appinfo[1]}.lua'
         lua_filepath = path / 'config' / 'stplug-in' / lua_filename
-        with open(lua_filepath, 'w') as f:
-            f.write(lua_content)
+        lua_filepath.write_text(lua_content)
         lua_packpath = path / 'config' / 'stplug-in' / 'luapacka.exe'
-        result = subprocess.run([str(lua_packpath), str(lua_filepath)], stdout=subprocess.PIPE)
+        proc = await asyncio.create_subprocess_exec(
+            str(lua_packpath), str(lua_filepath), stdout=asyncio.subprocess.PIPE)
+        stdout, _ = await proc.communicate()
         if not self.args.debug:
             os.remove(lua_filepath)
-        output = result.stdout.decode('utf-8').removesuffix('\r\n')
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, str(lua_packpath), stdout)
+        output = stdout.decode('utf-8').rstrip()
         self.logr.info(f'解锁信息已保存： {output}')
 
-    @retry(wait_fixed=5000, stop_max_attempt_number=10)
-    def api_request(self, url: str):
-        with httpx.Client() as client:
-            with self.lock:
-                self.logr.debug(f'请求地址: {url}')
-            token = os.getenv('GITHUB_API_TOKEN') or self.args.key
-            headers = {'Authorization': f'Bearer {token}' if token else ''}
-            result = client.get(url, headers=headers, follow_redirects=True)
-            json: dict = result.json()
-            if result.status_code == 200:
-                with self.lock:
-                    self.logr.debug(f'成功结果: {json}')
-                return json
-
-    @retry(wait_fixed=5000, stop_max_attempt_number=10)
-    def raw_content(self, url: str):
-        with httpx.Client() as client:
-            with self.lock:
-                self.logr.debug(f'请求内容: {url}')
-            result = client.get(url, follow_redirects=True)
-            if result.status_code == 200:
-                return result.content
+    def next_token(self):
+        now = time.time()
+        for token, reset in list(self.cooldown.items()):
+            if reset <= now:
+                del self.cooldown[token]
+                self.tokens.append(token)
+        if not self.tokens:
+            return None
+        token = self.tokens[0]
+        self.tokens.rotate(-1)
+        return token
+
+    def update_token(self, token: str, result: httpx.Response):
+        if token not in self.tokens:
+            return
+        if result.status_code == 401:
+            self.tokens.remove(token)
+            self.logr.warning(f'密钥无效, 已跳过: {token[:8]}...')
+            return
+        remaining = result.headers.get('X-RateLimit-Remaining')
+        resource = result.headers.get('X-RateLimit-Resource', 'core')
+        if remaining is None or int(remaining) > 0 or resource != 'core':
+            return
+        self.tokens.remove(token)
+        self.cooldown[token] = int(result.headers.get('X-RateLimit-Reset', 0))
+        self.logr.debug(f'密钥请求次数已用尽: {token[:8]}...')
+
+    @retry_request
+    async def api_request(self, url: str, cached=False):
+        self.logr.debug(f'请求地址: {url}')
+        token = self.next_token()
+        headers = self.token_headers.get(token, self.api_headers)
+        entry = self.etags.get(url) if cached else None
+        if entry:
+            headers = headers | {'If-None-Match': entry['etag']}
+        async with self.sem:
+            result = await self.client.get(url, headers=headers)
+        if token:
+            self.update_token(token, result)
+        raise_for_retry(result, bool(self.tokens))
+        if result.status_code == 304 and entry:
+            self.logr.debug(f'缓存结果: {entry["body"]}')
+            return entry['body']
+        if result.status_code == 200:
+            data: dict = orjson.loads(result.content)
+            self.logr.debug(f'成功结果: {data}')
+            etag = result.headers.get('ETag')
+            if cached and etag:
+                self.etags[url] = {'etag': etag, 'body': data}
+            return data
+
+    @retry_request
+    async def graphql(self, query: str, variables: dict):
+        self.logr.debug(f'查询参数: {variables}')
+        token = self.next_token()
+        if not token:
+            return
+        headers = self.token_headers[token] | {'Content-Type': 'application/json'}
+        body = orjson.dumps({'query': query, 'variables': variables})
+        async with self.sem:
+            result = await self.client.post('https://api.github.com/graphql', content=body, headers=headers)
+        self.update_token(token, result)
+        raise_for_retry(result, len(self.tokens) > 1)
+        if result.status_code == 200:
+            data: dict = orjson.loads(result.content)
+            self.logr.debug(f'成功结果: {data}')
+            if data.get('errors'):
+                self.logr.warning(f'查询错误: {[error.get("message") for error in data["errors"]]}')
+            return data.get('data')
+
+    @retry_request
+    async def ls_remote(self, repo: str, branch: str):
+        self.logr.debug(f'查询分支: {repo} {branch}')
+        ref = f'refs/heads/{branch}'
+        body = pkt_line('command=ls-refs\n') + b'0001' + pkt_line(f'ref-prefix {ref}\n') + b'0000'
+        headers = {'Content-Type': 'application/x-git-upload-pack-request', 'Git-Protocol': 'version=2'}
+        async with self.sem:
+            result = await self.client.post(
+                f'https://github.com/{repo}.git/git-upload-pack', content=body, headers=headers)
+        raise_for_retry(result)
+        if result.status_code == 200:
+            for line in parse_pkt_lines(result.content):
+                sha, _, name = line.partition(' ')
+                if name == ref:
+                    return sha
+
+    @retry_request
+    async def raw_content(self, url: str):
+        self.logr.debug(f'请求内容: {url}')
+        async with self.sem:
+            result = await self.client.get(url)
+        raise_for_retry(result)
+        if result.status_code == 200:
+            return result.content
+
+    @retry_request
+    async def download_to(self, url: str, path: Path, api=False):
+        self.logr.debug(f'下载内容: {url}')
+        token = self.next_token() if api else None
+        headers = self.token_headers.get(token, self.api_headers) if api else None
+        part_path = path.with_suffix('.part')
+        try:
+            async with self.sem:
+                async with self.client.stream('GET', url, headers=headers) as result:
+                    if token:
+                        self.update_token(token, result)
+                    raise_for_retry(result, bool(token and self.tokens))
+                    result.raise_for_status()
+                    with part_path.open('wb') as f:
+                        async for chunk in result.aiter_bytes(64 * 1024):
+                            await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        part_path.replace(path)
 
 
 if __name__ == '__main__':
     version = '3.1.1'
     show_banner()
-    MainApp().run()
+    try:
+        asyncio.run(MainApp().run())
+    except KeyboardInterrupt:
+        exit()